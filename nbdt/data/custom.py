@@ -3,14 +3,20 @@ import torch
 import numpy as np
 from torch.utils.data import Dataset
 from collections import defaultdict
+from functools import lru_cache
 from nbdt.utils import DATASET_TO_NUM_CLASSES, DATASETS
 from collections import defaultdict
-from nbdt.graph import get_wnids, read_graph, get_leaves, get_non_leaves, \
-    FakeSynset, get_leaf_to_path, wnid_to_synset, wnid_to_name
+from nbdt.graph import get_wnids, read_graph, get_non_leaves, \
+    get_node_to_leaves, get_root, FakeSynset, get_leaf_to_path, wnid_to_synset, wnid_to_name
 from . import imagenet
 import torch.nn as nn
 import random
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 __all__ = names = ('CIFAR10IncludeLabels',
                    'CIFAR100IncludeLabels', 'TinyImagenet200IncludeLabels',
@@ -29,6 +35,19 @@ def add_arguments(parser):
     parser.add_argument('--include-classes', nargs='*', type=int)
 
 
+if numba is not None:
+    @numba.njit(cache=True)
+    def filter_labels(targets, mask):
+        """Indices of all samples whose label is set in the boolean `mask`."""
+        indices = np.empty(targets.shape[0], dtype=np.int64)
+        n = 0
+        for i in range(targets.shape[0]):
+            if mask[targets[i]]:
+                indices[n] = i
+                n += 1
+        return indices[:n]
+
+
 def dataset_to_dummy_classes(dataset):
     assert dataset in DATASETS
     num_classes = DATASET_TO_NUM_CLASSES[dataset]
@@ -37,13 +56,17 @@ def dataset_to_dummy_classes(dataset):
 
 class Node:
 
-    def __init__(self, wnid, classes, path_graph, path_wnids, other_class=False):
+    def __init__(self, wnid, classes, path_graph, path_wnids, other_class=False,
+            G=None, wnids=None, wnid_to_index=None, node_to_leaves=None):
         self.path_graph = path_graph
         self.path_wnids = path_wnids
 
         self.wnid = wnid
-        self.wnids = get_wnids(path_wnids)
-        self.G = read_graph(path_graph)
+        self.wnids = wnids if wnids is not None else get_wnids(path_wnids)
+        self.G = G if G is not None else read_graph(path_graph)
+        self.wnid_to_index = wnid_to_index or {
+            wnid: index for index, wnid in enumerate(self.wnids)}
+        self.node_to_leaves = node_to_leaves or get_node_to_leaves(self.G)
         self.synset = wnid_to_synset(wnid)
 
         self.original_classes = classes
@@ -54,8 +77,9 @@ class Node:
         self.num_children = len(self.get_children())
         self.num_classes = self.num_children + int(self.has_other)
 
-        self.old_to_new_classes, self.new_to_old_classes = \
-            self.build_class_mappings()
+        self.old_to_new_classes, self.new_to_old_classes, \
+            self.old_to_new_lut = self.build_class_mappings()
+        self.old_to_new_weights = self.build_class_weights_matrix()
         self.classes = self.build_classes()
 
         assert len(self.classes) == self.num_classes, (
@@ -71,7 +95,7 @@ class Node:
         self._class_weights = None
 
     def wnid_to_class_index(self, wnid):
-        return self.wnids.index(wnid)
+        return self.wnid_to_index[wnid]
 
     def get_parents(self):
         return self.G.pred[self.wnid]
@@ -80,7 +104,7 @@ class Node:
         return self.G.succ[self.wnid]
 
     def get_leaves(self):
-        return get_leaves(self.G, self.wnid)
+        return iter(self.node_to_leaves[self.wnid])
 
     def is_leaf(self):
         return len(self.get_children()) == 0
@@ -89,22 +113,40 @@ class Node:
         return len(self.get_parents()) == 0
 
     def build_class_mappings(self):
+        """Map old classes to new classes, in a single pass over the leaves.
+
+        Also returns `old_to_new_lut`, a tensor mapping each old class to its
+        first new class, or -1 if the old class is not beneath this node.
+        """
         old_to_new = defaultdict(lambda: [])
         new_to_old = defaultdict(lambda: [])
+        lut = np.full(self.num_original_classes, -1, dtype=np.int64)
         for new_index, child in enumerate(self.get_children()):
-            for leaf in get_leaves(self.G, child):
+            for leaf in self.node_to_leaves[child]:
                 old_index = self.wnid_to_class_index(leaf)
                 old_to_new[old_index].append(new_index)
                 new_to_old[new_index].append(old_index)
-        if not self.has_other:
-            return old_to_new, new_to_old
-
-        new_index = self.num_children
-        for old in range(self.num_original_classes):
-            if old not in old_to_new:
+                if lut[old_index] == -1:
+                    lut[old_index] = new_index
+
+        unmapped = np.flatnonzero(lut == -1)
+        if self.has_other and unmapped.size:
+            new_index = self.num_children
+            lut[unmapped] = new_index
+            new_to_old[new_index] = unmapped.tolist()
+            for old in new_to_old[new_index]:
                 old_to_new[old].append(new_index)
-                new_to_old[new_index].append(old)
-        return old_to_new, new_to_old
+        return old_to_new, new_to_old, torch.from_numpy(lut)
+
+    def build_class_weights_matrix(self):
+        """Matrix averaging the outputs of all old classes in each new class.
+
+        Multiplying network outputs by this matrix gives the node's logits.
+        """
+        weights = torch.zeros((self.num_original_classes, self.num_classes))
+        for new_index, old_indices in self.new_to_old_classes.items():
+            weights[old_indices, new_index] = 1. / len(old_indices)
+        return weights
 
     def build_classes(self):
         return [
@@ -116,7 +158,9 @@ class Node:
     @property
     def class_counts(self):
         """Number of old classes in each new class"""
-        return [len(old_indices) for old_indices in self.new_to_old_classes]
+        return np.fromiter(
+            (len(self.new_to_old_classes[new]) for new in range(self.num_classes)),
+            dtype=np.int64, count=self.num_classes)
 
     @property
     def probabilities(self):
@@ -127,11 +171,10 @@ class Node:
         issues.
         """
         if self._probabilities is None:
-            reference = min(self.class_counts)
-            self._probabilities = torch.Tensor([
-                min(1, reference / len(old_indices))
-                for old_indices in self.new_to_old_classes
-            ])
+            counts = self.class_counts
+            probabilities = np.minimum(1, counts.min() / counts)
+            self._probabilities = torch.from_numpy(
+                probabilities.astype(np.float32))
         return self._probabilities
 
     @probabilities.setter
@@ -150,11 +193,29 @@ class Node:
 
     @staticmethod
     def get_wnid_to_node(path_graph, path_wnids, classes):
+        """Build all nodes for a hierarchy.
+
+        Results are cached, so that e.g., the loss and the model share the same
+        nodes. The returned dict is a copy, but the nodes themselves are shared:
+        setting e.g., `probabilities` or `class_weights` on a node affects all
+        callers with the same hierarchy.
+        """
+        return dict(Node._get_wnid_to_node(
+            path_graph, path_wnids, tuple(classes)))
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _get_wnid_to_node(path_graph, path_wnids, classes):
         wnid_to_node = {}
         G = read_graph(path_graph)
+        wnids = get_wnids(path_wnids)
+        wnid_to_index = {wnid: index for index, wnid in enumerate(wnids)}
+        node_to_leaves = get_node_to_leaves(G)
         for wnid in get_non_leaves(G):
             wnid_to_node[wnid] = Node(
-                wnid, classes, path_graph=path_graph, path_wnids=path_wnids)
+                wnid, classes, path_graph=path_graph, path_wnids=path_wnids,
+                G=G, wnids=wnids, wnid_to_index=wnid_to_index,
+                node_to_leaves=node_to_leaves)
         return wnid_to_node
 
     @staticmethod
@@ -182,18 +243,17 @@ class Node:
 
     @staticmethod
     def get_root_node_wnid(path_graph):
-        raise UserWarning('Root node may have wnid now')
-        tree = ET.parse(path_graph)
-        for node in tree.iter():
-            wnid = node.get('wnid')
-            if wnid is not None:
-                return wnid
-        return None
+        return get_root(read_graph(path_graph))
 
     @staticmethod
     def dim(nodes):
         return sum([node.num_classes for node in nodes])
 
+    @staticmethod
+    def get_old_to_new_lut(nodes):
+        """Stack every node's old-to-new lookup table, one row per node."""
+        return torch.stack([node.old_to_new_lut for node in nodes])
+
 
 class ResampleLabelsDataset(Dataset):
     """
@@ -203,20 +263,37 @@ class ResampleLabelsDataset(Dataset):
     :drop_classes bool: Modifies the dataset so that it is only a m-way
                         classification where m of k classes are kept. Otherwise,
                         the problem is still k-way.
+    :cache bool: Keep every loaded (sample, label) pair in memory, so that each
+                 sample is only loaded and transformed once. Only use this with
+                 deterministic transforms, and with enough memory for the
+                 whole dataset. The cache lives in whichever process calls
+                 `__getitem__`, so it is only reused across epochs with
+                 `num_workers=0`, or with `persistent_workers=True`. Otherwise,
+                 DataLoader workers, and their caches, are discarded after
+                 every epoch, before any sample is loaded a second time.
+    :use_numba bool: Filter include/exclude labels with the numba-compiled
+                     `filter_labels`, instead of a numpy mask. Requires numba.
     """
 
     accepts_probability_labels = True
 
-    def __init__(self, dataset, probability_labels=1, drop_classes=False, seed=0):
+    def __init__(self, dataset, probability_labels=1, drop_classes=False, seed=0,
+            cache=False, use_numba=False):
+        assert not use_numba or numba is not None, \
+            '`use_numba` requires numba to be installed'
         self.dataset = dataset
+        self.use_numba = use_numba
+        self.cache = cache
+        self._cache = {}
         self.classes = dataset.classes
         self.labels = list(range(len(self.classes)))
         self.probability_labels = self.get_probability_labels(dataset, probability_labels)
 
         self.drop_classes = drop_classes
         if self.drop_classes:
-            self.classes, self.labels = self.get_classes_after_drop(
-                dataset, probability_labels)
+            self.classes, self.labels = self.apply_drop(
+                dataset, self.probability_labels)
+        self.label_to_new = {label: i for i, label in enumerate(self.labels)}
 
         assert self.labels, 'No labels are included in `include_labels`'
 
@@ -249,22 +326,46 @@ class ResampleLabelsDataset(Dataset):
 
         Additionally, the outputted list is truncated to match the number of
         desired samples.
+
+        If the dataset exposes `targets`, labels are read from there, instead
+        of loading every sample just to read its label. If additionally every
+        label is either always or never kept, no sampling is needed, and the
+        labels are filtered with a vectorized numpy mask, or with the numba
+        `filter_labels` if `use_numba` is set.
         """
         random.seed(seed)
 
+        targets = getattr(self.dataset, 'targets', None)
+        if targets is not None and set(self.probability_labels) <= {0, 1}:
+            mask = np.asarray(self.probability_labels, dtype=np.bool_)
+            targets = np.asarray(targets, dtype=np.int64)
+            if self.use_numba:
+                return filter_labels(targets, mask)
+            return np.flatnonzero(mask[targets])
+        if targets is None:
+            targets = (label for _, label in self.dataset)
+
         new_to_old = []
-        for old, (_, label) in enumerate(self.dataset):
+        for old, label in enumerate(targets):
             if random.random() < self.probability_labels[label]:
                 new_to_old.append(old)
         return new_to_old
 
+    def get_old_item(self, index_old):
+        if index_old in self._cache:
+            return self._cache[index_old]
+        item = self.dataset[index_old]
+        if self.cache:
+            self._cache[index_old] = item
+        return item
+
     def __getitem__(self, index_new):
-        index_old = self.new_to_old[index_new]
-        sample, label_old = self.dataset[index_old]
+        index_old = int(self.new_to_old[index_new])
+        sample, label_old = self.get_old_item(index_old)
 
         label_new = label_old
         if self.drop_classes:
-            label_new = self.include_labels.index(label_old)
+            label_new = self.label_to_new[label_old]
 
         return sample, label_new
 
@@ -277,42 +378,56 @@ class IncludeLabelsDataset(ResampleLabelsDataset):
     accepts_include_labels = True
     accepts_probability_labels = False
 
-    def __init__(self, dataset, include_labels=(0,)):
+    def __init__(self, dataset, include_labels=(0,), cache=False,
+            use_numba=False):
+        include_labels = frozenset(include_labels)
         super().__init__(dataset, probability_labels=[
             int(cls in include_labels) for cls in range(len(dataset.classes))
-        ])
+        ], cache=cache, use_numba=use_numba)
 
 
 class CIFAR10ResampleLabels(ResampleLabelsDataset):
 
-    def __init__(self, *args, root='./data', probability_labels=1, **kwargs):
+    def __init__(self, *args, root='./data', probability_labels=1, cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=datasets.CIFAR10(*args, root=root, **kwargs),
-            probability_labels=probability_labels)
+            probability_labels=probability_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class CIFAR100ResampleLabels(ResampleLabelsDataset):
 
-    def __init__(self, *args, root='./data', probability_labels=1, **kwargs):
+    def __init__(self, *args, root='./data', probability_labels=1, cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=datasets.CIFAR100(*args, root=root, **kwargs),
-            probability_labels=probability_labels)
+            probability_labels=probability_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class TinyImagenet200ResampleLabels(ResampleLabelsDataset):
 
-    def __init__(self, *args, root='./data', probability_labels=1, **kwargs):
+    def __init__(self, *args, root='./data', probability_labels=1, cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=imagenet.TinyImagenet200(*args, root=root, **kwargs),
-            probability_labels=probability_labels)
+            probability_labels=probability_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class Imagenet1000ResampleLabels(ResampleLabelsDataset):
 
-    def __init__(self, *args, root='./data', probability_labels=1, **kwargs):
+    def __init__(self, *args, root='./data', probability_labels=1, cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=imagenet.Imagenet1000(*args, root=root, **kwargs),
-            probability_labels=probability_labels)
+            probability_labels=probability_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class IncludeClassesDataset(IncludeLabelsDataset):
@@ -324,42 +439,56 @@ class IncludeClassesDataset(IncludeLabelsDataset):
     accepts_include_labels = False
     accepts_include_classes = True
 
-    def __init__(self, dataset, include_classes=()):
+    def __init__(self, dataset, include_classes=(), cache=False,
+            use_numba=False):
+        class_to_label = {cls: i for i, cls in enumerate(dataset.classes)}
         super().__init__(dataset, include_labels=[
-                dataset.classes.index(cls) for cls in include_classes
-            ])
+                class_to_label[cls] for cls in include_classes
+            ], cache=cache, use_numba=use_numba)
 
 
 class CIFAR10IncludeLabels(IncludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', include_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', include_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=datasets.CIFAR10(*args, root=root, **kwargs),
-            include_labels=include_labels)
+            include_labels=include_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class CIFAR100IncludeLabels(IncludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', include_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', include_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=datasets.CIFAR100(*args, root=root, **kwargs),
-            include_labels=include_labels)
+            include_labels=include_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class TinyImagenet200IncludeLabels(IncludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', include_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', include_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=imagenet.TinyImagenet200(*args, root=root, **kwargs),
-            include_labels=include_labels)
+            include_labels=include_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class Imagenet1000IncludeLabels(IncludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', include_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', include_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=imagenet.Imagenet1000(*args, root=root, **kwargs),
-            include_labels=include_labels)
+            include_labels=include_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class ExcludeLabelsDataset(IncludeLabelsDataset):
@@ -367,41 +496,56 @@ class ExcludeLabelsDataset(IncludeLabelsDataset):
     accepts_include_labels = False
     accepts_exclude_labels = True
 
-    def __init__(self, dataset, exclude_labels=(0,)):
+    def __init__(self, dataset, exclude_labels=(0,), cache=False,
+            use_numba=False):
         k = len(dataset.classes)
         include_labels = set(range(k)) - set(exclude_labels)
         super().__init__(
             dataset=dataset,
-            include_labels=include_labels)
+            include_labels=include_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class CIFAR10ExcludeLabels(ExcludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', exclude_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', exclude_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=datasets.CIFAR10(*args, root=root, **kwargs),
-            exclude_labels=exclude_labels)
+            exclude_labels=exclude_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class CIFAR100ExcludeLabels(ExcludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', exclude_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', exclude_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=datasets.CIFAR100(*args, root=root, **kwargs),
-            exclude_labels=exclude_labels)
+            exclude_labels=exclude_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class TinyImagenet200ExcludeLabels(ExcludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', exclude_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', exclude_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=imagenet.TinyImagenet200(*args, root=root, **kwargs),
-            exclude_labels=exclude_labels)
+            exclude_labels=exclude_labels,
+            cache=cache,
+            use_numba=use_numba)
 
 
 class Imagenet1000ExcludeLabels(ExcludeLabelsDataset):
 
-    def __init__(self, *args, root='./data', exclude_labels=(0,), **kwargs):
+    def __init__(self, *args, root='./data', exclude_labels=(0,), cache=False,
+            use_numba=False, **kwargs):
         super().__init__(
             dataset=imagenet.Imagenet1000(*args, root=root, **kwargs),
-            exclude_labels=exclude_labels)
+            exclude_labels=exclude_labels,
+            cache=cache,
+            use_numba=use_numba)
@@ -69,6 +69,10 @@ class TinyImagenet200(Dataset):
         with zipfile.ZipFile(str(path)) as zf:
             zf.extractall(root)
 
+    @property
+    def targets(self):
+        return self.dataset.targets
+
     def __getitem__(self, i):
         return self.dataset[i]
 
@@ -98,6 +102,10 @@ class _TinyImagenet200Val(datasets.ImageFolder):
         self.class_to_idx = {
             label: self.classes.index(label) for label in self.classes
         }
+        self.targets = [
+            self.class_to_idx[self.path_to_class[path]]
+            for path, _ in self.samples
+        ]
 
     def __getitem__(self, i):
         sample, _ = super().__getitem__(i)
@@ -155,6 +163,10 @@ class Imagenet1000(Dataset):
             transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
         ])
 
+    @property
+    def targets(self):
+        return self.dataset.targets
+
     def __getitem__(self, i):
         return self.dataset[i]
 
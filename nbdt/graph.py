@@ -154,7 +154,7 @@ def get_wnids(path_wnids):
         print(f'No such file or directory: {path_wnids}. Looking in {str(parent)}')
         path_wnids = parent / path_wnids
     with open(path_wnids) as f:
-        wnids = [wnid.strip() for wnid in f.readlines()]
+        wnids = f.read().split()
     return wnids
 
 
@@ -227,15 +227,29 @@ def get_leaves(G, root=None):
             yield node
 
 
+def get_node_to_leaves(G):
+    """Map every node to the leaves beneath it, in one bottom-up pass."""
+    node_to_leaves = {}
+    for node in reversed(list(nx.topological_sort(G))):
+        if is_leaf(G, node):
+            node_to_leaves[node] = [node]
+            continue
+        leaves = {}
+        for child in G.succ[node]:
+            leaves.update(dict.fromkeys(node_to_leaves[child]))
+        node_to_leaves[node] = list(leaves)
+    return node_to_leaves
+
+
 def get_non_leaves(G):
-    for node in G.nodes:
-        if len(G.succ[node]) > 0:
+    for node, succ in G.succ.items():
+        if succ:
             yield node
 
 
 def get_roots(G):
-    for node in G.nodes:
-        if len(G.pred[node]) == 0:
+    for node, pred in G.pred.items():
+        if not pred:
             yield node
 
 
@@ -127,6 +127,10 @@ class TreeSupLoss(nn.Module):
 
 class HardTreeSupLoss(TreeSupLoss):
 
+    def init(self, *args, **kwargs):
+        super().init(*args, **kwargs)
+        self.old_to_new_lut = Node.get_old_to_new_lut(self.nodes)
+
     def forward(self, outputs, targets):
         """
         The supplementary losses are all uniformly down-weighted so that on
@@ -146,20 +150,20 @@ class HardTreeSupLoss(TreeSupLoss):
 
         outputs_subs = defaultdict(lambda: [])
         targets_subs = defaultdict(lambda: [])
-        targets_ints = [int(target) for target in targets.cpu().long()]
-        for node in self.nodes:
+        targets_new = self.old_to_new_lut[:, targets.cpu().long()]
+        for node, node_targets in zip(self.nodes, targets_new):
             _, outputs_sub, targets_sub = \
-                HardEmbeddedDecisionRules.get_node_logits_filtered(
-                    node, outputs, targets_ints)
+                HardEmbeddedDecisionRules.get_node_logits_selected(
+                    node, outputs, node_targets)
 
             key = node.num_classes
             assert outputs_sub.size(0) == len(targets_sub)
             outputs_subs[key].append(outputs_sub)
-            targets_subs[key].extend(targets_sub)
+            targets_subs[key].append(targets_sub)
 
         for key in outputs_subs:
             outputs_sub = torch.cat(outputs_subs[key], dim=0)
-            targets_sub = torch.Tensor(targets_subs[key]).long().to(outputs_sub.device)
+            targets_sub = torch.cat(targets_subs[key], dim=0).to(outputs_sub.device)
 
             if not outputs_sub.size(0):
                 continue
@@ -67,27 +67,46 @@ class EmbeddedDecisionRules(nn.Module):
         self.total = 0
 
         self.I = torch.eye(len(classes))
+        self.node_weights = self.get_node_weights(self.nodes)
+
+    @staticmethod
+    def get_node_weights(nodes):
+        """Matrix mapping network outputs to the logits of all nodes at once.
+
+        Concatenates each node's `old_to_new_weights` along dim 1, so columns
+        for each node follow those of the previous nodes.
+        """
+        return torch.cat([node.old_to_new_weights for node in nodes], dim=1)
 
     @staticmethod
     def get_node_logits(outputs, node):
         """Get output for a particular node
 
-        This `outputs` above are the output of the neural network.
+        This `outputs` above are the output of the neural network. Each new
+        class's logit is the average of the outputs for its old classes.
         """
-        return torch.stack([
-            outputs.T[node.new_to_old_classes[new_label]].mean(dim=0)
-            for new_label in range(node.num_classes)
-        ]).T
+        return outputs.matmul(node.old_to_new_weights.to(
+            device=outputs.device, dtype=outputs.dtype))
 
     @classmethod
-    def get_all_node_outputs(cls, outputs, nodes):
+    def get_all_node_outputs(cls, outputs, nodes, node_weights=None):
         """Run hard embedded decision rules.
 
-        Returns the output for *every single node.
+        Returns the output for *every single node. Logits for all nodes are
+        computed with a single matrix multiply (see `get_node_weights`). If
+        `node_weights` is not provided, it is concatenated and moved to the
+        outputs' device on every call; pass `get_node_weights(nodes)` to reuse
+        it across calls.
         """
+        if node_weights is None:
+            node_weights = cls.get_node_weights(nodes)
+        all_logits = outputs.matmul(
+            node_weights.to(device=outputs.device, dtype=outputs.dtype))
+        all_node_logits = all_logits.split(
+            [node.num_classes for node in nodes], dim=-1)
+
         wnid_to_outputs = {}
-        for node in nodes:
-            node_logits = cls.get_node_logits(outputs, node)
+        for node, node_logits in zip(nodes, all_node_logits):
             node_outputs = {'logits': node_logits}
 
             if len(node_logits.size()) > 1:
@@ -98,7 +117,9 @@ class EmbeddedDecisionRules(nn.Module):
         return wnid_to_outputs
 
     def forward_nodes(self, outputs):
-        return self.get_all_node_outputs(outputs, self.nodes)
+        if self.node_weights.device != outputs.device:
+            self.node_weights = self.node_weights.to(outputs.device)
+        return self.get_all_node_outputs(outputs, self.nodes, self.node_weights)
 
 
 class HardEmbeddedDecisionRules(EmbeddedDecisionRules):
@@ -109,12 +130,25 @@ class HardEmbeddedDecisionRules(EmbeddedDecisionRules):
 
         If you have targets for the node, you can selectively perform inference,
         only for nodes where the label of a sample is well-defined.
+
+        `targets` may be a list of ints or a tensor. Returns the selector (bool
+        tensor), node logits and node targets (LongTensor) for selected samples.
+        """
+        targets = torch.as_tensor(targets).long().cpu()
+        return cls.get_node_logits_selected(
+            node, outputs, node.old_to_new_lut[targets])
+
+    @classmethod
+    def get_node_logits_selected(cls, node, outputs, targets_new):
+        """Same as `get_node_logits_filtered`, for already-remapped targets.
+
+        `targets_new` holds each sample's new class for this node, or -1 if
+        the sample's label is not beneath this node.
         """
-        classes = [node.old_to_new_classes[int(t)] for t in targets]
-        selector = [bool(cls) for cls in classes]
-        targets_sub = [cls[0] for cls in classes if cls]
+        selector = targets_new >= 0
+        targets_sub = targets_new[selector]
 
-        outputs = outputs[selector]
+        outputs = outputs[selector.to(outputs.device)]
         if outputs.size(0) == 0:
             return selector, outputs[:, :node.num_classes], targets_sub
 
@@ -139,6 +173,7 @@ class HardEmbeddedDecisionRules(EmbeddedDecisionRules):
             outputs['probs'] = outputs['probs'].detach().cpu()
 
         wnid_to_node = {node.wnid: node for node in nodes}
+        class_to_index = {cls: i for i, cls in enumerate(classes)}
         wnid_root = get_root(nodes[0].G)
         node_root = wnid_to_node[wnid_root]
 
@@ -158,7 +193,7 @@ class HardEmbeddedDecisionRules(EmbeddedDecisionRules):
                 node = wnid_to_node.get(wnid, None)
                 decision.append({'node': node, 'name': wnid_to_name(wnid), 'prob': prob_child})
             cls = wnid_to_class.get(wnid, None)
-            pred = -1 if cls is None else classes.index(cls)
+            pred = class_to_index.get(cls, -1)
             preds.append(pred)
             decisions.append(decision)
         return torch.Tensor(preds).long().to(device), decisions
@@ -184,42 +219,67 @@ class HardEmbeddedDecisionRules(EmbeddedDecisionRules):
 
 class SoftEmbeddedDecisionRules(EmbeddedDecisionRules):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path_indices = self.get_path_indices(self.nodes)
+
+    @staticmethod
+    def get_path_indices(nodes):
+        """Columns to multiply together, to obtain each leaf's probability.
+
+        Node probabilities are concatenated along dim 1, followed by a single
+        column of ones. Row i holds the columns, one per node that contains
+        leaf i, whose product is the probability of leaf i. Rows are padded
+        with the index of the column of ones, so that all rows are equally
+        long.
+        """
+        num_classes = len(nodes[0].original_classes)
+        class_to_indices = [[] for _ in range(num_classes)]
+        offset = 0
+        for node in nodes:
+            old_indices = []
+            for index_child in range(len(node.children)):
+                for old in node.new_to_old_classes[index_child]:
+                    class_to_indices[old].append(offset + index_child)
+                    old_indices.append(old)
+
+            assert len(set(old_indices)) == len(old_indices), (
+                'All old indices must be unique in order for this operation '
+                'to be correct.'
+            )
+            offset += node.num_classes
+
+        depth = max(len(indices) for indices in class_to_indices)
+        return torch.LongTensor([
+            indices + [offset] * (depth - len(indices))
+            for indices in class_to_indices
+        ])
+
     @classmethod
-    def traverse_tree(cls, wnid_to_outputs, nodes):
+    def traverse_tree(cls, wnid_to_outputs, nodes, path_indices=None):
         """
-        In theory, the loop over children below could be replaced with just a
-        few lines:
+        In theory, this could be written as a loop over all nodes and children:
 
             for index_child in range(len(node.children)):
                 old_indexes = node.new_to_old_classes[index_child]
                 class_probs[:,old_indexes] *= output[:,index_child][:,None]
 
-        However, we collect all indices first, so that only one tensor operation
-        is run. The output is a single distribution over all leaves. The
-        ordering is determined by the original ordering of the provided logits.
-        (I think. Need to check nbdt.data.custom.Node)
+        However, the indices are precomputed once (see `get_path_indices`), so
+        that a single gather and product is run. The output is a single
+        distribution over all leaves. The ordering is determined by the
+        original ordering of the provided logits.
         """
+        if path_indices is None:
+            path_indices = cls.get_path_indices(nodes)
+
         example = wnid_to_outputs[nodes[0].wnid]
         num_samples = example['logits'].size(0)
-        num_classes = len(nodes[0].original_classes)
         device = example['logits'].device
-        class_probs = torch.ones((num_samples, num_classes)).to(device)
-
-        for node in nodes:
-            outputs = wnid_to_outputs[node.wnid]
-
-            old_indices, new_indices = [], []
-            for index_child in range(len(node.children)):
-                old = node.new_to_old_classes[index_child]
-                old_indices.extend(old)
-                new_indices.extend([index_child] * len(old))
 
-            assert len(set(old_indices)) == len(old_indices), (
-                'All old indices must be unique in order for this operation '
-                'to be correct.'
-            )
-            class_probs[:,old_indices] *= outputs['probs'][:,new_indices]
-        return class_probs
+        probs = torch.cat([
+            wnid_to_outputs[node.wnid]['probs'] for node in nodes
+        ] + [torch.ones((num_samples, 1)).to(device)], dim=1)
+        return probs[:, path_indices.to(device)].prod(dim=2)
 
     def forward_with_decisions(self, outputs):
         outputs = self.forward(outputs)
@@ -237,8 +297,11 @@ class SoftEmbeddedDecisionRules(EmbeddedDecisionRules):
         return outputs, decisions
 
     def forward(self, outputs):
+        if self.path_indices.device != outputs.device:
+            self.path_indices = self.path_indices.to(outputs.device)
         wnid_to_outputs = self.forward_nodes(outputs)
-        logits = self.traverse_tree(wnid_to_outputs, self.nodes)
+        logits = self.traverse_tree(
+            wnid_to_outputs, self.nodes, self.path_indices)
         logits._nbdt_output_flag = True  # checked in nbdt losses, to prevent mistakes
         return logits
 
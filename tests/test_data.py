@@ -0,0 +1,145 @@
+"""Tests that nodes and custom datasets are built correctly"""
+
+import numpy as np
+import pytest
+import torch
+import nbdt.data.custom as custom
+from collections import defaultdict
+from PIL import Image
+from torch.utils.data import Dataset
+from nbdt.data.custom import Node, IncludeLabelsDataset, \
+    dataset_to_dummy_classes
+from nbdt.data.imagenet import _TinyImagenet200Val
+from nbdt.graph import get_leaves
+from nbdt.utils import (
+    dataset_to_default_path_graph, dataset_to_default_path_wnids)
+
+
+class CountingDataset(Dataset):
+    """Tiny dataset that counts how many samples were loaded"""
+
+    classes = ('a', 'b')
+
+    def __init__(self):
+        self.targets = [0, 1, 0, 1]
+        self.num_loads = 0
+
+    def __getitem__(self, i):
+        self.num_loads += 1
+        return torch.zeros(1), self.targets[i]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def get_node_args(dataset):
+    return (
+        dataset_to_dummy_classes(dataset),
+        dataset_to_default_path_graph(dataset),
+        dataset_to_default_path_wnids(dataset))
+
+
+def get_nodes(dataset):
+    classes, path_graph, path_wnids = get_node_args(dataset)
+    return Node.get_nodes(path_graph, path_wnids, classes)
+
+
+def build_class_mappings_reference(node):
+    """Class mappings, as originally computed in three passes"""
+    old_to_new = defaultdict(lambda: [])
+    new_to_old = defaultdict(lambda: [])
+    for new_index, child in enumerate(node.get_children()):
+        for leaf in get_leaves(node.G, child):
+            old_index = node.wnids.index(leaf)
+            old_to_new[old_index].append(new_index)
+            new_to_old[new_index].append(old_index)
+    if not node.has_other:
+        return old_to_new, new_to_old
+
+    new_index = node.num_children
+    for old in range(node.num_original_classes):
+        if old not in old_to_new:
+            old_to_new[old].append(new_index)
+            new_to_old[new_index].append(old)
+    return old_to_new, new_to_old
+
+
+def test_old_to_new_lut_cifar10():
+    for node in get_nodes('CIFAR10'):
+        for old in range(node.num_original_classes):
+            new_indices = node.old_to_new_classes.get(old)
+            expected = new_indices[0] if new_indices else -1
+            assert int(node.old_to_new_lut[old]) == expected
+
+
+def test_other_class_mappings_cifar10():
+    classes, path_graph, path_wnids = get_node_args('CIFAR10')
+    wnid = next(
+        node.wnid for node in get_nodes('CIFAR10') if not node.is_root())
+    node = Node(wnid, classes, path_graph, path_wnids, other_class=True)
+    assert node.has_other
+
+    old_to_new, new_to_old = build_class_mappings_reference(node)
+    assert len(new_to_old) == node.num_classes
+    for new in range(node.num_classes):
+        assert sorted(node.new_to_old_classes[new]) == sorted(new_to_old[new])
+        assert sorted(node.classes[new].split(',')) == sorted(
+            classes[old] for old in new_to_old[new])
+    for old in range(node.num_original_classes):
+        assert node.old_to_new_classes[old] == old_to_new[old]
+        assert int(node.old_to_new_lut[old]) == old_to_new[old][0]
+
+
+def test_tinyimagenet200_val_targets(tmp_path):
+    directory = tmp_path / 'tiny-imagenet-200' / 'val'
+    (directory / 'images').mkdir(parents=True)
+    annotations = []
+    wnids = ('n01443537', 'n01629819', 'n01443537', 'n01641577')
+    for i, wnid in enumerate(wnids):
+        fname = f'val_{i}.JPEG'
+        Image.new('RGB', (2, 2)).save(str(directory / 'images' / fname), 'JPEG')
+        annotations.append(f'{fname}\t{wnid}\t0\t0\t1\t1')
+    (directory / 'val_annotations.txt').write_text('\n'.join(annotations))
+
+    dataset = _TinyImagenet200Val(root=str(tmp_path))
+    assert len(dataset.targets) == len(dataset) == len(wnids)
+    assert len(set(dataset.targets)) == len(set(wnids))
+    for i in range(len(dataset)):
+        assert dataset.targets[i] == dataset[i][1]
+
+
+def test_include_labels_cache():
+    dataset = CountingDataset()
+    include = IncludeLabelsDataset(dataset, include_labels=(1,), cache=True)
+    assert len(include) == 2
+    assert dataset.num_loads == 0
+
+    assert include[0][1] == 1
+    assert dataset.num_loads == 1
+    assert include[0][1] == 1
+    assert dataset.num_loads == 1
+
+
+def test_include_labels_no_cache():
+    dataset = CountingDataset()
+    include = IncludeLabelsDataset(dataset, include_labels=(1,))
+    include[0]
+    include[0]
+    assert dataset.num_loads == 2
+
+
+def test_include_labels_numba():
+    pytest.importorskip('numba')
+    for include_labels in ((1,), (0, 1), ()):
+        expected = IncludeLabelsDataset(
+            CountingDataset(), include_labels=include_labels).new_to_old
+        actual = IncludeLabelsDataset(
+            CountingDataset(), include_labels=include_labels,
+            use_numba=True).new_to_old
+        assert np.array_equal(actual, expected)
+
+
+def test_include_labels_numba_not_installed(monkeypatch):
+    monkeypatch.setattr(custom, 'numba', None)
+    with pytest.raises(AssertionError):
+        IncludeLabelsDataset(CountingDataset(), use_numba=True)
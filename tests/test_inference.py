@@ -1,6 +1,56 @@
 """Tests that models work inference-time"""
 
-from nbdt.model import SoftNBDT, HardNBDT
+import pytest
+import torch
+from conftest import get_node_logits_reference
+from nbdt.data.custom import Node
+from nbdt.model import SoftNBDT, HardNBDT, SoftEmbeddedDecisionRules, \
+    HardEmbeddedDecisionRules
+
+
+@pytest.mark.parametrize('dataset,num_classes', [('CIFAR10', 10), ('CIFAR100', 100)])
+def test_node_outputs_match_reference(dataset, num_classes):
+    rules = HardEmbeddedDecisionRules(dataset)
+    outputs = torch.randn(4, num_classes)
+    for node_weights in (rules.node_weights, None):
+        wnid_to_outputs = rules.get_all_node_outputs(
+            outputs, rules.nodes, node_weights)
+        for node in rules.nodes:
+            expected = get_node_logits_reference(outputs, node)
+            assert torch.allclose(
+                wnid_to_outputs[node.wnid]['logits'], expected, atol=1e-6)
+            assert torch.allclose(
+                rules.get_node_logits(outputs, node), expected, atol=1e-6)
+
+
+def soft_traverse_tree_reference(wnid_to_outputs, nodes):
+    """Soft inference, as originally computed with one product per node"""
+    example = wnid_to_outputs[nodes[0].wnid]
+    num_samples = example['logits'].size(0)
+    class_probs = torch.ones((num_samples, len(nodes[0].original_classes)))
+    for node in nodes:
+        outputs = wnid_to_outputs[node.wnid]
+        old_indices, new_indices = [], []
+        for index_child in range(len(node.children)):
+            old = node.new_to_old_classes[index_child]
+            old_indices.extend(old)
+            new_indices.extend([index_child] * len(old))
+        class_probs[:,old_indices] *= outputs['probs'][:,new_indices]
+    return class_probs
+
+
+@pytest.mark.parametrize('dataset,num_classes', [('CIFAR10', 10), ('CIFAR100', 100)])
+def test_soft_traverse_tree_matches_reference(dataset, num_classes):
+    rules = SoftEmbeddedDecisionRules(dataset)
+    padding = Node.dim(rules.nodes)
+    assert (rules.path_indices == padding).any(), \
+        'Expected leaves at different depths, so that paths are padded'
+
+    wnid_to_outputs = rules.forward_nodes(torch.randn(4, num_classes))
+    expected = soft_traverse_tree_reference(wnid_to_outputs, rules.nodes)
+    actual = rules.traverse_tree(
+        wnid_to_outputs, rules.nodes, rules.path_indices)
+    assert torch.allclose(actual, expected)
 
 
 def test_nbdt_soft_cifar10(input_cifar10, resnet18_cifar10):
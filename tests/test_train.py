@@ -2,10 +2,43 @@
 
 import torch
 import torch.nn as nn
+from collections import defaultdict
+from conftest import get_node_logits_reference
 from nbdt.loss import SoftTreeSupLoss, HardTreeSupLoss
 from nbdt.model import HardNBDT
 
 
+def hard_tree_sup_loss_reference(loss_fn, outputs, targets):
+    """Hard tree supervision loss, as originally computed with Python lists"""
+    loss = loss_fn.criterion(outputs, targets)
+    num_losses = outputs.size(0) * len(loss_fn.nodes) / 2.
+
+    outputs_subs = defaultdict(lambda: [])
+    targets_subs = defaultdict(lambda: [])
+    for node in loss_fn.nodes:
+        classes = [node.old_to_new_classes.get(int(t), []) for t in targets]
+        selector = [bool(cls) for cls in classes]
+        targets_sub = [cls[0] for cls in classes if cls]
+
+        outputs_sub = outputs[selector]
+        if outputs_sub.size(0) == 0:
+            outputs_sub = outputs_sub[:, :node.num_classes]
+        else:
+            outputs_sub = get_node_logits_reference(outputs_sub, node)
+        outputs_subs[node.num_classes].append(outputs_sub)
+        targets_subs[node.num_classes].extend(targets_sub)
+
+    for key in outputs_subs:
+        outputs_sub = torch.cat(outputs_subs[key], dim=0)
+        targets_sub = torch.Tensor(targets_subs[key]).long()
+        if not outputs_sub.size(0):
+            continue
+        fraction = outputs_sub.size(0) / float(num_losses) \
+            * loss_fn.tree_supervision_weight
+        loss += loss_fn.criterion(outputs_sub, targets_sub) * fraction
+    return loss
+
+
 def test_criterion_cifar10(criterion, label_cifar10):
     criterion = SoftTreeSupLoss(dataset='CIFAR10', criterion=criterion, hierarchy='induced')
     criterion(torch.randn((1, 10)), label_cifar10)
@@ -37,3 +70,11 @@ def test_nbdt_gradient_soft(resnet18_cifar10, input_cifar10, label_cifar10, crit
     criterion = SoftTreeSupLoss(dataset='CIFAR10', criterion=criterion, hierarchy='induced')
     loss = criterion(output_cifar10, label_cifar10)
     loss.backward()
+
+
+def test_hard_criterion_matches_list_based_loss(criterion):
+    criterion = HardTreeSupLoss(dataset='CIFAR10', criterion=criterion, hierarchy='induced')
+    outputs = torch.randn((16, 10))
+    targets = torch.randint(10, (16,))
+    expected = hard_tree_sup_loss_reference(criterion, outputs, targets)
+    assert torch.allclose(criterion(outputs, targets), expected)